@@ -0,0 +1,9 @@
+import os
+import torch
+
+# Use expandable segments in the cuda caching allocator so the growing datasets
+# and per-round loaders don't fragment GPU memory. This is read at the first cuda
+# allocation, so it only applies if lbi is imported before anything is moved
+# to the GPU. An explicit PYTORCH_CUDA_ALLOC_CONF always takes precedence.
+if torch.__version__ >= '2.1':
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
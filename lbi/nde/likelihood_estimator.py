@@ -16,5 +16,5 @@ class NeuralLikelihoodEstimator(NeuralDensityEstimator):
         return self.model.sample(n_samples, context=context.to(self.device))
 
     def _loss(self, data, context):
-        loss = -self.log_prob(data.to(self.device), context.to(self.device)).mean()
+        loss = -self.log_prob(data, context).mean()
         return loss
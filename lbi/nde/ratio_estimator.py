@@ -28,8 +28,9 @@ class NeuralRatioEstimator(NeuralDensityEstimator):
 
     def _loss(self, data, context):
         def split_in_half(a_list):
+            # drop the last row of odd batches so the halves can be paired
             half = len(a_list) // 2
-            return a_list[:half], a_list[half:]
+            return a_list[:half], a_list[half:2*half]
 
         data_a, data_b = split_in_half(data)
         context_a, context_b = split_in_half(context)
@@ -3,8 +3,9 @@ import torch
 import torch.nn as nn
 from tqdm import tqdm
 import numpy as np
-import sklearn
 import os
+import warnings
+import contextlib
 from ..utils import is_notebook, Logger, get_gradient_norm, prep_log_dir
 from pyro.infer import MCMC, NUTS, Predictive
 import pickle
@@ -19,6 +20,7 @@ class Sequential():
                  num_samples_per_round=250,
                  summary_interval=50,
                  validation_interval=250,
+                 lazy_validation=False,
                  scaler=None,
                  param_scaler=None,
                  obs_truth=None,
@@ -32,9 +34,14 @@ class Sequential():
                  max_n_epochs=200,
                  valid_fraction=0.15,
                  batch_size=256,
+                 grad_accum_steps=1,
                  num_workers=0,
                  grad_clip=5.,
+                 mixed_precision=True,
+                 compile_model=False,
+                 storage_dtype=torch.float32,
                  patience=20,
+                 min_delta=1e-4,
                  log_dir='./runs/test_run/',
                  settings_path=None,
                  logger=None,
@@ -69,6 +76,10 @@ class Sequential():
                 Calculate training loss after this many steps
             validation_interval: int
                 Calculate validation loss after this many steps
+            lazy_validation: bool
+                Only calculate validation loss if the training loss since the last
+                validation reached a new minimum. Skipped validations count as no
+                improvement towards `patience`
             sims_per_model: int
                 Number of simulations to generate per MCMC sample
             mcmc_walkers: int
@@ -85,8 +96,27 @@ class Sequential():
                 Fraction of simulations to hold out for validation
             batch_size: int
                 Number of training samples to estimate gradient from
+            num_workers: int
+                Number of DataLoader worker processes. Workers persist across
+                the epochs of a round
+            grad_accum_steps: int
+                Number of batches to accumulate gradients over per optimizer step.
+                The effective batch size is batch_size * grad_accum_steps
             grad_clip: float
                 Value at which to clip the gradient norm during training
+            mixed_precision: bool
+                Train with automatic mixed precision (only takes effect on cuda)
+            compile_model: bool
+                Compile the training loss with torch.compile (torch>=2.0).
+                Falls back to eager mode if compilation fails
+            storage_dtype: torch.dtype
+                dtype used to store simulated data between rounds. torch.bfloat16
+                halves dataset memory at the cost of precision. Batches are cast
+                back to float32 before the loss
+            patience: int
+                Number of validations without improvement before early stopping
+            min_delta: float
+                Minimum decrease in validation loss that counts as an improvement
             log_dir: str
                 Location to store models and logs
             settings_path: str
@@ -126,6 +156,7 @@ class Sequential():
         self.num_samples_per_round = num_samples_per_round
         self.summary_interval = summary_interval
         self.validation_interval = validation_interval
+        self.lazy_validation = lazy_validation
         self.sims_per_model = sims_per_model
         self.mcmc_steps = mcmc_steps
         self.mcmc_discard = mcmc_discard
@@ -133,8 +164,12 @@ class Sequential():
         self.mcmc_walkers = mcmc_walkers
         self.max_n_epochs = max_n_epochs
         self.patience = patience
+        self.min_delta = min_delta
         self.valid_fraction = valid_fraction
         self.batch_size = batch_size
+        if grad_accum_steps < 1:
+            raise ValueError(f"grad_accum_steps must be at least 1, got {grad_accum_steps}")
+        self.grad_accum_steps = grad_accum_steps
         self.num_workers = num_workers
         self.grad_clip = grad_clip
         if settings_path is None:
@@ -152,82 +187,187 @@ class Sequential():
         self.best_val_loss = np.inf
         self.notebook = is_notebook()
         self.device = model.device
-
+        self.storage_dtype = storage_dtype
+        self.mixed_precision = mixed_precision and self.device.type == 'cuda'
+        if hasattr(torch.amp, 'GradScaler'):
+            self.grad_scaler = torch.amp.GradScaler(self.device.type, enabled=self.mixed_precision)
+        else:  # torch < 2.3
+            self.grad_scaler = torch.cuda.amp.GradScaler(enabled=self.mixed_precision)
+        self._compiled_loss = None
+        if compile_model and hasattr(torch, 'compile'):
+            self._compiled_loss = torch.compile(self.model._loss)
+
+        # (mean, scale) tensors of standard scalers, per scaler and device. Filled
+        # lazily so scalers may be fitted after construction
+        self._scaler_stats = {}
+
+        # simulations are kept in host memory and copied to self.device per batch.
+        # Each entry is a buffer whose capacity doubles when full, so adding a round
+        # only copies the new samples (amortized); get_data returns the filled part
         self.data = {
-            'train_data': torch.empty([0, self.data_dim]).cpu(),
-            'train_params': torch.empty([0, self.param_dim]).cpu(),
-            'valid_data': torch.empty([0, self.data_dim]).cpu(),
-            'valid_params': torch.empty([0, self.param_dim]).cpu()}
+            'train_data': torch.empty([0, self.data_dim], dtype=self.storage_dtype),
+            'train_params': torch.empty([0, self.param_dim]),
+            'valid_data': torch.empty([0, self.data_dim], dtype=self.storage_dtype),
+            'valid_params': torch.empty([0, self.param_dim])}
+        self._data_size = {key: 0 for key in self.data}
 
-        self.x0 = obs_data
+        # observations as a tensor on device, converted once for all samplers
+        self.x0 = torch.as_tensor(obs_data, dtype=torch.float32, device=self.device)
 
     def add_data(self, data, params):
+        # cast once on insertion so make_loaders can use the stored tensors as-is
+        data = data.to('cpu', dtype=torch.float32)
+        params = params.to('cpu', dtype=torch.float32)
         if self.scaler is not None:
-            data = data.cpu().numpy()
-            data = self.scaler.transform(data)
-            data = torch.from_numpy(data).float()
-        if self.param_scaler is not None:  # TODO: make this more general to work with other scalers
-            mean = torch.from_numpy(self.param_scaler.mean_).float()
-            scale = torch.from_numpy(self.param_scaler.scale_).float()
-            params = (params - mean)/scale
+            data = self._apply_scaler('scaler', data)
+        if self.param_scaler is not None:
+            params = self._apply_scaler('param_scaler', params)
 
         # Select samples for validation
         n = data.shape[0]
-        idx = sklearn.utils.shuffle(np.arange(n))
+        idx = torch.randperm(n, device=data.device)
         m = int(self.valid_fraction * n)
         valid_idx = idx[:m]
         train_idx = idx[m:]
 
         # Store samples in dictionary
-        self.data['train_data'] = torch.cat([self.data['train_data'], data[train_idx]], dim=0)
-        self.data['train_params'] = torch.cat([self.data['train_params'], params[train_idx]], dim=0)
-        self.data['valid_data'] = torch.cat([self.data['valid_data'], data[valid_idx]], dim=0)
-        self.data['valid_params'] = torch.cat([self.data['valid_params'], params[valid_idx]], dim=0)
+        data = data.to(self.storage_dtype)
+        self._append_data('train_data', data[train_idx])
+        self._append_data('train_params', params[train_idx])
+        self._append_data('valid_data', data[valid_idx])
+        self._append_data('valid_params', params[valid_idx])
+
+    def _append_data(self, key, x):
+        """
+        Copy x into the buffer self.data[key], doubling its capacity if needed
+        """
+        size = self._data_size[key]
+        buffer = self.data[key]
+        if size + x.shape[0] > buffer.shape[0]:
+            capacity = max(2 * buffer.shape[0], size + x.shape[0])
+            new_buffer = torch.empty([capacity, buffer.shape[1]], dtype=buffer.dtype)
+            new_buffer[:size] = buffer[:size]
+            self.data[key] = buffer = new_buffer
+        buffer[size:size + x.shape[0]] = x
+        self._data_size[key] = size + x.shape[0]
+
+    def _apply_scaler(self, name, x):
+        """
+        Apply the fitted sklearn scaler stored as `self.<name>` to tensor x.
+
+        Standard scalers are applied as a torch op on x's device (preserving
+        derivatives); any other scaler falls back to scaler.transform.
+        """
+        scaler = getattr(self, name)
+        key = (name, x.device)
+        if key not in self._scaler_stats:
+            mean = getattr(scaler, 'mean_', None)
+            scale = getattr(scaler, 'scale_', None)
+            uses_both = getattr(scaler, 'with_mean', True) and getattr(scaler, 'with_std', True)
+            if mean is None or scale is None or not uses_both:
+                data = scaler.transform(x.detach().cpu().numpy())
+                return torch.as_tensor(data, dtype=torch.float32, device=x.device)
+            self._scaler_stats[key] = (torch.as_tensor(mean, dtype=torch.float32, device=x.device),
+                                       torch.as_tensor(scale, dtype=torch.float32, device=x.device))
+        mean, scale = self._scaler_stats[key]
+        return (x - mean)/scale
+
+    def get_data(self, key):
+        """
+        Return all stored samples under `key` (e.g. 'train_data') as one tensor.
+        This is a view into the storage buffer, not a copy
+        """
+        return self.data[key][:self._data_size[key]]
 
     def simulate(self, params):
-        # TODO: Clean up numpy types
-        if type(params) is np.ndarray:
-            params = torch.from_numpy(params).float()
+        # as_tensor shares memory with float32 arrays/tensors and casts anything else once
+        params = torch.as_tensor(params, dtype=torch.float32)
 
         params = params.reshape([-1, self.param_dim])
-        params = torch.cat(self.sims_per_model * [params])
+        params = params.repeat_interleave(self.sims_per_model, dim=0)
 
         data = self.simulator(params, sims_per_model=self.sims_per_model)
-        if type(data) is np.ndarray:
-            # TODO: Make sure this works with cuda multiprocessing
-            data = torch.from_numpy(data)
+        # TODO: Make sure this works with cuda multiprocessing
+        # data is kept wherever the simulator produced it; add_data moves it to host storage
+        data = torch.as_tensor(data, dtype=torch.float32)
         data = data.reshape([-1, self.data_dim])
         assert params.shape[0] == data.shape[0], print(params.shape, data.shape)
 
         return data, params
 
     def make_loaders(self):
+        # pinned host memory lets the per-batch copies in train() run asynchronously
+        loader_kwargs = dict(batch_size=self.batch_size, num_workers=self.num_workers,
+                             pin_memory=self.device.type == 'cuda')
+        if self.num_workers > 0:
+            # keep workers alive across epochs instead of re-forking them every epoch
+            loader_kwargs.update(persistent_workers=True, prefetch_factor=2)
         train_dset = torch.utils.data.TensorDataset(
-            self.data['train_data'].float(),
-            self.data['train_params'].float())
+            self.get_data('train_data'),
+            self.get_data('train_params'))
         train_loader = torch.utils.data.DataLoader(
-            train_dset, batch_size=self.batch_size, shuffle=True, drop_last=True, num_workers=self.num_workers)
+            train_dset, shuffle=True, drop_last=True, **loader_kwargs)
 
         valid_dset = torch.utils.data.TensorDataset(
-            self.data['valid_data'].float(),
-            self.data['valid_params'].float())
+            self.get_data('valid_data'),
+            self.get_data('valid_params'))
+        # keep the last partial batch unless it is a single row, which losses that
+        # pair up samples (e.g. NeuralRatioEstimator) can't evaluate
         valid_loader = torch.utils.data.DataLoader(
-            valid_dset, batch_size=self.batch_size, shuffle=False, drop_last=True, num_workers=self.num_workers)
+            valid_dset, shuffle=False, drop_last=len(valid_dset) % self.batch_size == 1, **loader_kwargs)
 
         return train_loader, valid_loader
 
     def loss_func(self, data, params):
-        return self.model._loss(data.to(self.device), params.to(self.device))
+        """
+        Training loss for a batch already on self.device
+        """
+        if self._compiled_loss is not None:
+            return self._compiled_loss(data, params)
+        return self.model._loss(data, params)
+
+    def _autocast(self):
+        """
+        Autocast context for mixed precision training. A no-op when mixed precision
+        is off, since autocast can't be constructed on some devices (e.g. older mps)
+        """
+        if not self.mixed_precision:
+            return contextlib.nullcontext()
+        return torch.amp.autocast('cuda')
+
+    def _training_step(self, data, params):
+        """
+        Forward and backward pass for one batch. Returns the detached loss.
+
+        If torch.compile fails, in the forward or in the lazily compiled backward,
+        training continues in eager mode. Errors from the model itself are re-raised.
+        """
+        try:
+            with self._autocast():
+                loss = self.loss_func(data, params)
+            # average gradients over the batches accumulated into one step
+            self.grad_scaler.scale(loss / self.grad_accum_steps).backward()
+        except Exception as e:
+            if self._compiled_loss is None or not isinstance(e, torch._dynamo.exc.TorchDynamoException):
+                raise
+            warnings.warn(f"torch.compile failed, falling back to eager mode: {e}")
+            self._compiled_loss = None
+            return self._training_step(data, params)
+        return loss.detach()
 
     def train(self, global_step=0):
 
-        print(f"Training on {self.data['train_data'].shape[0]:,d} samples. "
-              f"Validating on {self.data['valid_data'].shape[0]:,d} samples.")
+        print(f"Training on {self.get_data('train_data').shape[0]:,d} samples. "
+              f"Validating on {self.get_data('valid_data').shape[0]:,d} samples.")
         train_loader, valid_loader = self.make_loaders()
 
         self.model.train()
-        total_loss = 0
+        # accumulate losses on device and only sync with .item() when reporting
+        total_loss = torch.zeros((), device=self.device)
+        interval_loss = torch.zeros((), device=self.device) if self.lazy_validation else None
+        best_interval_loss = np.inf
         epochs_without_improvement = 0
+        micro_step = 0
         # Train
         if self.progress:
             pbar = tqdm(range(self.max_n_epochs))
@@ -235,32 +375,56 @@ class Sequential():
             pbar = range(self.max_n_epochs)
         for epoch in pbar:
             for data, params in train_loader:
-                self.optimizer.zero_grad()
-                loss = self.loss_func(data.to(self.device), params.to(self.device))
-                loss.backward()
-                total_loss += loss.item()
+                if micro_step % self.grad_accum_steps == 0:
+                    self.optimizer.zero_grad(set_to_none=True)
+                loss = self._training_step(data.to(self.device, dtype=torch.float32, non_blocking=True),
+                                           params.to(self.device, non_blocking=True))
+                total_loss += loss
+                if self.lazy_validation:
+                    interval_loss += loss
+                micro_step += 1
+                if micro_step % self.grad_accum_steps != 0:
+                    continue
+                # unscale before clipping so grad_clip applies to the true gradient norm
+                self.grad_scaler.unscale_(self.optimizer)
                 nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
-                self.optimizer.step()
+                self.grad_scaler.step(self.optimizer)
+                self.grad_scaler.update()
                 global_step += 1
                 # Report training loss
                 if global_step % self.summary_interval == 0:
-                    train_loss = total_loss / float(self.summary_interval)
+                    train_loss = total_loss.item() / float(self.summary_interval * self.grad_accum_steps)
                     self.logger.add_scalar("Losses/train", train_loss, global_step=global_step)
                     for label, func in self.scalar_funcs.items():
                         self.logger.add_scalar(label, func(self), global_step=global_step)
-                    total_loss = 0
+                    total_loss.zero_()
+
+                # Skip validation if training loss hasn't improved since the last one
+                run_validation = global_step % self.validation_interval == 0
+                if run_validation and self.lazy_validation:
+                    train_interval_loss = interval_loss.item() / float(self.validation_interval * self.grad_accum_steps)
+                    interval_loss.zero_()
+                    if train_interval_loss < best_interval_loss:
+                        best_interval_loss = train_interval_loss
+                    else:
+                        epochs_without_improvement += 1
+                        run_validation = False
 
                 # Evaluate and report validation loss
-                if global_step % self.validation_interval == 0:
+                if run_validation and len(valid_loader) > 0:
                     self.model.eval()
-                    with torch.no_grad():
-                        total_loss = 0
-                        i = 0
-                        for i, (data, params) in enumerate(valid_loader):
-                            loss = self.model._loss(data.to(self.device), params.to(self.device))
-                            total_loss += loss.item()
-                    val_loss = total_loss / float(1 + i)
-                    if val_loss < self.best_val_loss:
+                    with torch.no_grad(), self._autocast():
+                        # weight each batch by its size so a short last batch isn't overweighted
+                        valid_loss = torch.zeros((), device=self.device)
+                        n_valid = 0
+                        for data, params in valid_loader:
+                            loss = self.model._loss(data.to(self.device, dtype=torch.float32, non_blocking=True),
+                                                    params.to(self.device, non_blocking=True))
+                            valid_loss += loss.detach() * data.shape[0]
+                            n_valid += data.shape[0]
+                    val_loss = valid_loss.item() / float(n_valid)
+                    # ignore near-ties so they don't trigger a checkpoint write
+                    if val_loss < self.best_val_loss - self.min_delta:
                         with open(self.model_path, 'wb') as f:
                             torch.save(self.model.state_dict(), f)
                         self.best_val_loss = val_loss
@@ -269,7 +433,6 @@ class Sequential():
                     if self.progress:
                         pbar.set_description(f"Validation Loss: {val_loss:.3f}")
                     self.logger.add_scalar("Losses/valid", val_loss, global_step=global_step)
-                    total_loss = 0
                 self.model.train()
 
             if epochs_without_improvement > self.patience:
@@ -279,31 +442,37 @@ class Sequential():
         return global_step
 
     def log_prior(self, params):
-        return self.priors.log_prob(params)
+        """
+        Log prior of each row of a (*, param_dim) batch of params
+        """
+        log_prob = self.priors.log_prob(params.reshape([-1, self.param_dim]))
+        if log_prob.dim() > 1:
+            # batch of independent 1d priors (e.g. Uniform(low, high) without Independent)
+            log_prob = log_prob.sum(-1)
+        return log_prob
 
     def log_prob(self, data, params=None):
         """
         Meant to  take care of scaling
         """
+        # move to device once; both are no-ops for the tensors used during sampling
         if params is not None:
+            params = params.to(self.device)
             if self.param_scaler is not None:
                 # doing it this way to preserve any derivatives (if necessary)
-                mean = torch.from_numpy(self.param_scaler.mean_).float().to(self.device)
-                scale = torch.from_numpy(self.param_scaler.scale_).float().to(self.device)
-                params = (params - mean)/scale
+                params = self._apply_scaler('param_scaler', params)
 
+        data = data.to(self.device, dtype=torch.float32)
         if self.scaler is not None:
-            data = self.scaler.transform(data.cpu().numpy())
-            data = torch.from_numpy(data)
+            data = self._apply_scaler('scaler', data)
 
-        data = data.float()
         # add correction from standard scalar
         if "Standard" in self.scaler.__str__():
             scaling_correction = - np.log(self.scaler.scale_.prod())
         else:
             scaling_correction = 0
 
-        return self.model.log_prob(data.to(self.device), params.to(self.device)) + scaling_correction
+        return self.model.log_prob(data, params) + scaling_correction
 
     def log_posterior(self, data=None, params=None, context=None, prior_only=False):
         if data is None:
@@ -314,33 +483,123 @@ class Sequential():
         if type(params) is np.ndarray:
             params = torch.from_numpy(params).float().to(self.device)
 
+        params = params.reshape([-1, self.param_dim])
         log_prob = self.log_prior(params)
         if not prior_only:
-            # params = torch.stack(self.x0.shape[0] * [params])
-            # print(self.x0.shape, params.shape)
             if context is None:
                 context = params
-            log_prob = log_prob + self.log_prob(data, context)
+            log_prob = log_prob + self.log_likelihood(data, context)
         return log_prob
 
-    def hmc(self, num_samples=50, walker_steps=200, burn_in=100, initial_params=None):
+    def log_likelihood(self, data, params):
+        """
+        Sum of log_prob over every observation in `data` for each row of `params`
+        """
+        n_obs, n_params = data.shape[0], params.shape[0]
+        if n_obs == 1:
+            # single observation: broadcast view, no copy
+            data = data.expand(n_params, -1)
+        elif n_params == 1:
+            params = params.expand(n_obs, -1)
+        else:
+            # every (param, observation) pair has to be materialized
+            data = data.repeat(n_params, 1)
+            params = params.repeat_interleave(n_obs, dim=0)
+        return self.log_prob(data, params).view(n_params, n_obs).sum(1)
+
+    def hmc(self, num_samples=50, walker_steps=200, burn_in=100, initial_params=None, n_walkers=1):
+        """
+        Sample the posterior with NUTS.
+
+        Parameters
+            num_samples: int
+                Number of posterior samples to return
+            walker_steps: int
+                Number of NUTS steps after warmup
+            burn_in: int
+                Number of warmup steps
+            initial_params: torch.Tensor (n_walkers, param_dim)
+                Starting positions. Defaults to prior samples
+            n_walkers: int
+                Number of walkers evaluated in one batched potential. The walkers
+                are not independent chains: they form a single NUTS chain over
+                the joint (n_walkers * param_dim) space and share one step size,
+                trajectory length and accept/reject decision. If any walker steps
+                outside the prior support, the potential raises for the whole
+                chain. Samples from all walkers are pooled
+        """
         def posterior_wrapper(param_dict):
             if param_dict is not None:
                 # TODO: Figure out if there's a way to pass params without dict
                 params = param_dict['params']
-                return -self.log_posterior(params)
+                # joint potential of all walkers, evaluated in a single batched forward pass
+                return -self.log_posterior(params=params).sum()
 
         if initial_params is None:
-            initial_params = self.priors.sample((1,))
+            initial_params = self.priors.sample((n_walkers,))
 
         nuts_kernel = NUTS(potential_fn=posterior_wrapper, adapt_step_size=True)
         mcmc = MCMC(nuts_kernel, num_samples=walker_steps, warmup_steps=burn_in,
                     initial_params={"params": initial_params})
 
-        #TODO: make sure x0 is being used in posterior (because it's not being used in run)
-        # mcmc.run(self.x0)
         mcmc.run()
-        return mcmc.get_samples(num_samples)['params'].view(num_samples, -1)
+        # (walker_steps, n_walkers, param_dim) -> pool samples from all walkers
+        samples = mcmc.get_samples()['params'].reshape([-1, self.param_dim])
+        idx = torch.randint(0, samples.shape[0], (num_samples,))
+        return samples[idx]
+
+    def _ensemble_log_posterior(self, params):
+        """
+        numpy in/out wrapper of log_posterior for emcee, evaluating all walkers
+        at once. Walkers outside the prior support get -inf without evaluating
+        the model.
+        """
+        # the prior is evaluated on the host, where priors.sample puts its samples;
+        # only the likelihood runs on self.device
+        params = torch.as_tensor(params, dtype=torch.float32)
+
+        if hasattr(self.priors, 'support'):
+            in_support = self.priors.support.check(params)
+            if in_support.dim() > 1:
+                in_support = in_support.all(-1)
+        else:
+            in_support = torch.ones(params.shape[0], dtype=torch.bool)
+
+        log_prob = torch.full([params.shape[0]], -np.inf)
+        with torch.no_grad():
+            if in_support.any():
+                params = params[in_support]
+                log_likelihood = self.log_likelihood(self.x0, params.to(self.device))
+                log_prob[in_support] = self.log_prior(params) + log_likelihood.cpu()
+        return log_prob.numpy()
+
+    def ensemble_sample(self, num_samples=50, initial_params=None):
+        """
+        Sample the posterior with emcee's affine-invariant ensemble sampler,
+        using mcmc_walkers, mcmc_steps, mcmc_discard and mcmc_thin. All walkers
+        are evaluated in a single batched call on self.device.
+
+        Parameters
+            num_samples: int
+                Number of posterior samples to return
+            initial_params: torch.Tensor (n_walkers, param_dim)
+                Starting positions of the walkers. Defaults to
+                max(mcmc_walkers, 2 * param_dim) prior samples, since emcee
+                requires at least 2 * param_dim walkers
+        """
+        import emcee  # optional dependency
+
+        if initial_params is None:
+            initial_params = self.priors.sample((max(self.mcmc_walkers, 2 * self.param_dim),))
+        initial_params = torch.as_tensor(initial_params).reshape([-1, self.param_dim]).cpu().numpy()
+
+        sampler = emcee.EnsembleSampler(initial_params.shape[0], self.param_dim,
+                                        self._ensemble_log_posterior, vectorize=True)
+        sampler.run_mcmc(initial_params, self.mcmc_steps, progress=self.progress)
+        chain = sampler.get_chain(discard=self.mcmc_discard, thin=self.mcmc_thin, flat=True)
+
+        idx = np.random.randint(0, chain.shape[0], size=num_samples)
+        return torch.from_numpy(chain[idx]).float()
 
     def sample_prior(self, num_samples=1000, prior_only=True):
         if prior_only:
@@ -27,6 +27,8 @@ def get_n_params(model):
 def get_gradient_norm(model):
     total_norm = 0
     for p in model.parameters():
+        if p.grad is None:
+            continue
         param_norm = p.grad.data.norm(2)
         total_norm += param_norm.item() ** 2
     return total_norm ** (0.5)
@@ -24,6 +24,7 @@ setup_keywords['provides'] = [setup_keywords['name']]
 setup_keywords['requires'] = ['Python (>3.7.0)']
 setup_keywords['install_requires'] = [
     'torch', 'nflows', 'pyro-ppl', 'corner', 'scikit-learn', 'tqdm']
+setup_keywords['extras_require'] = {'emcee': ['emcee']}
 setup_keywords['zip_safe'] = False
 setup_keywords['use_2to3'] = False
 setup_keywords['packages'] = find_packages()